@@ -1,25 +1,47 @@
 import asyncio
+import io
 import json
 import logging
 import os
 import re
-import smtplib
-import tempfile
-from dataclasses import dataclass
+import string
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Tuple
 
 import aiofiles
+import aiosmtplib
 import dns.resolver
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import ContentType, ParseMode
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # orjson опционален — падаем обратно на stdlib
+    _json_loads = json.loads
+
 # --- Конфигурация ---
 COMMON_EMAIL_DOMAINS = ["gmail.com"]
+_SUPPORTED_SUFFIXES = tuple(f"@{domain}" for domain in COMMON_EMAIL_DOMAINS)
 MAX_CONCURRENT_REQUESTS = 10
+MAX_CONCURRENT_SENDS = 5
 VALID_EMAILS_FILE = "valid_emails.txt"
 SMTP_TIMEOUT_SECONDS = 5
 
+# --- Скомпилированные шаблоны парсера ---
+_RE_SCAN = re.compile(
+    r"(?P<boundary>🔸CAROUSELL)"
+    r"|(?P<photo>https://media\.karousell\.com\S+)"
+    r"|🗂 Товар:\s*(?P<title>.+)"
+    r"|💵 Цена:\s*(?P<price>.+)"
+    r"|\[🔗 Ссылка на товар\]\((?P<link>https?://[^\)]+)\)"
+    r"|👤 Продавец:\s*(?P<seller>[A-Za-z0-9_.-]+)"
+)
+_SELLER_CHARS = frozenset(string.ascii_letters + string.digits + "_.-")
+
 # --- Логирование ---
 logging.basicConfig(
     level=logging.INFO,
@@ -35,111 +57,160 @@ class EmailVerifier:
         self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
         self.valid_emails = self.load_valid_emails()
         self.new_valid_emails = set()
+        self._mx_cache: Dict[str, str] = {}
+        # Выделенный пул: не конкурируем за default executor с asyncio.to_thread
+        self._pool = ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS, thread_name_prefix='smtp')
         logger.info(f"✅ EmailVerifier initialized. {len(self.valid_emails)} cached emails loaded.")
 
     def load_valid_emails(self) -> set:
-        """Загрузка кэшированных адресов."""
+        """Загрузка кэшированных адресов одним чтением файла."""
         path = Path(VALID_EMAILS_FILE)
         if path.exists():
-            with path.open("r", encoding="utf-8") as file:
-                return {line.strip() for line in file if line.strip()}
+            return set(path.read_text(encoding="utf-8").split())
         return set()
 
     async def save_valid_emails(self):
         """Сохраняет новые валидные email после завершения обработки."""
         if not self.new_valid_emails:
             return
+        payload = "\n".join(self.new_valid_emails) + "\n"
         async with aiofiles.open(VALID_EMAILS_FILE, 'a') as f:
-            for email in self.new_valid_emails:
-                await f.write(email + '\n')
+            await f.write(payload)
         logger.info(f"💾 Saved {len(self.new_valid_emails)} new valid emails to file.")
         self.new_valid_emails.clear()
 
+    async def verify_many(self, emails: Iterable[str]) -> Dict[str, bool]:
+        """Асинхронная верификация набора email с кэшированием.
+
+        Адреса группируются по домену, и каждая группа проверяется через одну
+        SMTP-сессию к MX-хосту (много RCPT TO вместо соединения на адрес).
+        Семафор ограничивает число одновременных SMTP-сессий.
+        """
+        results: Dict[str, bool] = {}
+        by_domain: Dict[str, List[str]] = {}
+        for email in emails:
+            normalized = email.strip().lower()
+            if normalized in self.valid_emails:
+                results[normalized] = True
+            elif not self.is_supported_domain(normalized):
+                results[normalized] = False
+            else:
+                by_domain.setdefault(normalized.rsplit('@', 1)[1], []).append(normalized)
+
+        async def check_domain(domain: str, batch: List[str]) -> Dict[str, bool]:
+            async with self.semaphore:
+                return await self.check_mailboxes_exist(domain, batch)
+
+        batch_results = await asyncio.gather(
+            *(check_domain(domain, batch) for domain, batch in by_domain.items())
+        )
+        for batch_result in batch_results:
+            for normalized, valid in batch_result.items():
+                results[normalized] = valid
+                if valid:
+                    self.valid_emails.add(normalized)
+                    self.new_valid_emails.add(normalized)
+        return results
+
     async def verify(self, email: str) -> bool:
-        """Асинхронная верификация email с кэшированием."""
-        normalized = email.strip().lower()
-        if normalized in self.valid_emails:
-            return True
-        async with self.semaphore:
-            result = await asyncio.to_thread(self.check_mailbox_exists, normalized)
-            if result:
-                self.valid_emails.add(normalized)
-                self.new_valid_emails.add(normalized)
-            return result
-
-    def check_mailbox_exists(self, email: str) -> bool:
-        """Проверяет deliverability через SMTP для поддерживаемых доменов."""
-        if not self.is_supported_domain(email):
-            return False
-        try:
-            _, domain = email.split('@', 1)
-            records = dns.resolver.resolve(domain, 'MX')
-            mx_record = str(records[0].exchange)
+        """Асинхронная верификация одного email."""
+        results = await self.verify_many([email])
+        return results[email.strip().lower()]
 
-            with smtplib.SMTP(mx_record, timeout=SMTP_TIMEOUT_SECONDS) as server:
-                server.helo()
-                server.mail('me@example.com')
-                code, _ = server.rcpt(email)
+    async def check_mailboxes_exist(self, domain: str, emails: List[str]) -> Dict[str, bool]:
+        """Проверяет deliverability адресов одного домена в одной SMTP-сессии."""
+        results = {email: False for email in emails}
+        try:
+            # dns.resolver блокирующий — оставляем его в выделенном пуле
+            mx_record = await asyncio.get_running_loop().run_in_executor(
+                self._pool, self.resolve_mx, domain
+            )
 
-            return code == 250
+            async with aiosmtplib.SMTP(hostname=mx_record, timeout=SMTP_TIMEOUT_SECONDS) as server:
+                await server.helo()
+                await server.mail('me@example.com')
+                for email in emails:
+                    try:
+                        response = await server.rcpt(email)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        raise
+                    except aiosmtplib.SMTPException as exc:
+                        logger.debug(f"RCPT failed for {email}: {exc}")
+                        continue
+                    results[email] = response.code == 250
         except Exception as exc:  # noqa: BLE001 - логируем и возвращаем False
-            logger.debug(f"SMTP check failed for {email}: {exc}")
-            return False
+            logger.debug(f"SMTP batch check failed for {domain}: {exc}")
+        return results
+
+    def resolve_mx(self, domain: str) -> str:
+        """Резолвит MX-хост домена с кэшированием (повторный resolve гонки не ломает)."""
+        mx_record = self._mx_cache.get(domain)
+        if mx_record is None:
+            records = dns.resolver.resolve(domain, 'MX')
+            mx_record = self._mx_cache.setdefault(domain, str(records[0].exchange))
+        return mx_record
 
     @staticmethod
     def is_supported_domain(email: str) -> bool:
-        return any(email.endswith(f"@{domain}") for domain in COMMON_EMAIL_DOMAINS)
+        return email.endswith(_SUPPORTED_SUFFIXES)
 
 
 # --- Парсинг Carousell ---
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Listing:
     photo: str
     title: str
     price: str
     link: str
     seller: str
+    email: str = field(init=False)
 
-    @property
-    def email(self) -> str:
-        return f"{self.seller.lower()}@{COMMON_EMAIL_DOMAINS[0]}"
+    def __post_init__(self):
+        # frozen=True запрещает обычное присваивание — считаем email один раз здесь
+        object.__setattr__(self, "email", f"{self.seller.lower()}@{COMMON_EMAIL_DOMAINS[0]}")
 
 
 class FileParser:
-    @staticmethod
-    async def read_async(path: Path) -> str:
-        async with aiofiles.open(path, 'r', encoding='utf-8', errors='ignore') as f:
-            return await f.read()
-
     @staticmethod
     def parse(file_content: str) -> Tuple[List[Listing], str]:
         """Определяет формат файла и парсит данные."""
-        file_content = file_content.strip().replace("\ufeff", "")
-        try:
-            data = json.loads(file_content)
-            listings = FileParser.parse_carousell_json(data)
-            if listings:
-                return FileParser.deduplicate_listings(listings), "Atom Parser"
-        except json.JSONDecodeError:
-            pass
+        file_content = file_content.removeprefix("\ufeff").strip()
+        # Дешёвая проверка первого символа: не гоняем json.loads по G6-тексту
+        if file_content[:1] in ("{", "["):
+            try:
+                data = _json_loads(file_content)
+                listings = FileParser.parse_carousell_json(data)
+                if listings:
+                    return FileParser.deduplicate_listings(listings), "Atom Parser"
+            except ValueError:
+                pass
 
         listings = FileParser.parse_carousell_blocks(file_content)
         return FileParser.deduplicate_listings(listings), "G6 Parser"
 
     @staticmethod
     def parse_carousell_blocks(file_content: str) -> List[Listing]:
-        """Парсит старый текстовый формат Carousell."""
-        product_blocks = re.split(r"🔸CAROUSELL", file_content)
-        listings: List[Listing] = []
-
-        for block in product_blocks:
-            sanitized = block.strip()
-            if not sanitized:
-                continue
+        """Парсит старый текстовый формат Carousell одним проходом по файлу.
 
-            listing = FileParser._build_listing_from_block(sanitized)
-            if listing:
-                listings.append(listing)
+        Разделитель блоков входит в общий шаблон, поэтому файл сканируется
+        один раз вместо split + повторного поиска по каждому блоку.
+        """
+        listings: List[Listing] = []
+        fields: Dict[str, str] = {}
+
+        for match in _RE_SCAN.finditer(file_content):
+            group = match.lastgroup
+            if group == "boundary":
+                listing = FileParser._build_listing_from_fields(fields)
+                if listing:
+                    listings.append(listing)
+                fields = {}
+            else:
+                fields[group] = match.group(group).strip()
+
+        listing = FileParser._build_listing_from_fields(fields)
+        if listing:
+            listings.append(listing)
         return listings
 
     @staticmethod
@@ -169,43 +240,21 @@ class FileParser:
 
     @staticmethod
     def deduplicate_listings(listings: Iterable[Listing]) -> List[Listing]:
-        """Убирает дубликаты по продавцу и ссылке."""
-        seen = set()
-        unique: List[Listing] = []
+        """Убирает дубликаты по продавцу и ссылке (первое вхождение побеждает)."""
+        unique: Dict[Tuple[str, str], Listing] = {}
         for listing in listings:
-            key = (listing.seller.lower(), listing.link)
-            if key in seen:
-                continue
-            seen.add(key)
-            unique.append(listing)
-        return unique
+            unique.setdefault((listing.seller.lower(), listing.link), listing)
+        return list(unique.values())
 
     @staticmethod
-    def _build_listing_from_block(block: str) -> Optional[Listing]:
-        photo = FileParser.extract_value(r"(https://media\.karousell\.com[^\s]+)", block)
-        title = FileParser.extract_value(r"🗂 Товар:\s*(.+)", block)
-        price = FileParser.extract_value(r"💵 Цена:\s*(.+)", block)
-        link = FileParser.extract_value(r"\[🔗 Ссылка на товар\]\((https?://[^\)]+)\)", block)
-        seller = FileParser.extract_value(r"👤 Продавец:\s*([A-Za-z0-9_.-]+)", block)
-
-        if all([photo, title, price, link, seller]) and FileParser.is_valid_seller(seller):
-            return Listing(
-                photo=photo.strip(),
-                title=title.strip(),
-                price=price.strip(),
-                link=link.strip(),
-                seller=seller.strip(),
-            )
+    def _build_listing_from_fields(fields: Dict[str, str]) -> Optional[Listing]:
+        if len(fields) == 5 and FileParser.is_valid_seller(fields["seller"]):
+            return Listing(**fields)
         return None
 
-    @staticmethod
-    def extract_value(pattern: str, text: str) -> Optional[str]:
-        match = re.search(pattern, text)
-        return match.group(1).strip() if match else None
-
     @staticmethod
     def is_valid_seller(seller: Optional[str]) -> bool:
-        return bool(seller) and bool(re.fullmatch(r"[A-Za-z0-9_.-]{4,30}", seller))
+        return bool(seller) and 4 <= len(seller) <= 30 and _SELLER_CHARS.issuperset(seller)
 
 
 # --- Telegram Bot ---
@@ -226,17 +275,19 @@ class TelegramBot:
     async def handle_document(self, message: types.Message):
         """Обработка загруженных файлов"""
         document = message.document
-        temp_path = Path(f"temp_{document.file_id}.txt")
         try:
             await message.reply(
                 f"📂 Received file: <b>{document.file_name}</b>\n⏳ Processing...",
                 parse_mode=ParseMode.HTML,
             )
             file = await self.bot.get_file(document.file_id)
-            await file.download(destination=temp_path)
+            # Качаем сразу в память: без temp-файла в CWD и лишних create/unlink
+            buffer = io.BytesIO()
+            await file.download(destination=buffer)
+            content = buffer.getvalue().decode('utf-8', errors='ignore')
 
-            content = await FileParser.read_async(temp_path)
-            listings, parser_name = FileParser.parse(content)
+            # Парсинг CPU-bound: уводим в тред, чтобы не блокировать event loop
+            listings, parser_name = await asyncio.to_thread(FileParser.parse, content)
 
             if not listings:
                 await message.answer(
@@ -256,38 +307,42 @@ class TelegramBot:
         except Exception as e:
             logger.error(f"Error processing file {document.file_name}: {e}")
             await message.reply("⚠️ Error while processing file.")
-        finally:
-            if temp_path.exists():
-                temp_path.unlink()
 
     async def verify_all(self, listings: Iterable[Listing]) -> List[Dict[str, object]]:
-        """Параллельная проверка всех email."""
-        tasks = []
+        """Параллельная проверка всех email (каждый уникальный адрес — один раз)."""
         normalized_listings = list(listings)
-        for listing in normalized_listings:
-            email = listing.email
-            already_verified = email in self.verifier.valid_emails
-            tasks.append((email, already_verified, self.verifier.verify(email)))
+        unique_emails = list(dict.fromkeys(listing.email for listing in normalized_listings))
+        already_verified = {email: email in self.verifier.valid_emails for email in unique_emails}
 
-        results = await asyncio.gather(*(task[2] for task in tasks))
+        valid_map = await self.verifier.verify_many(unique_emails)
 
         return [
             {
-                "listing": normalized_listings[i],
-                "email": tasks[i][0],
-                "already_verified": tasks[i][1],
-                "valid": results[i],
+                "listing": listing,
+                "email": listing.email,
+                "already_verified": already_verified[listing.email],
+                "valid": valid_map[listing.email],
             }
-            for i in range(len(normalized_listings))
+            for listing in normalized_listings
         ]
 
     async def send_results(self, msg: types.Message, filename: str, results: List[Dict[str, object]]):
         """Отправка результатов пользователю."""
-        valid_new = [r for r in results if r["valid"] and not r["already_verified"]]
-        valid_cached = [r for r in results if r["valid"] and r["already_verified"]]
-        invalid = [r for r in results if not r["valid"]]
-
-        for r in valid_new:
+        valid_new: List[Dict[str, object]] = []
+        valid_cached: List[Dict[str, object]] = []
+        invalid: List[Dict[str, object]] = []
+        for r in results:
+            if not r["valid"]:
+                invalid.append(r)
+            elif r["already_verified"]:
+                valid_cached.append(r)
+            else:
+                valid_new.append(r)
+
+        # Параллельные отправки с ограничением, чтобы не упереться в лимиты Telegram
+        send_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+        async def send_listing(r: Dict[str, object]):
             listing: Listing = r["listing"]
             email = r["email"]
             formatted = (
@@ -297,7 +352,10 @@ class TelegramBot:
                 f"💰 <b>Price:</b> <code>{listing.price}</code>\n"
                 f"🔗 <a href=\"{listing.link}\">Link</a>"
             )
-            await msg.answer(formatted, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            async with send_semaphore:
+                await msg.answer(formatted, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+        await asyncio.gather(*(send_listing(r) for r in valid_new))
 
         summary = (
             f"📊 <b>{filename}</b>\n\n"
@@ -320,19 +378,20 @@ class TelegramBot:
             await msg.answer("📄 Нет валидных email для экспорта.")
             return
 
-        lines = ["email | title"]
-        for result in valid_results:
-            listing: Listing = result["listing"]
-            lines.append(f"{result['email']} | {listing.title}")
+        def export_lines():
+            yield "email | title\n"
+            for result in valid_results:
+                listing: Listing = result["listing"]
+                yield f"{result['email']} | {listing.title}\n"
 
-        temp_file = None
+        temp_path: Optional[Path] = None
         try:
-            temp_file = tempfile.NamedTemporaryFile(
-                "w+", encoding="utf-8", delete=False, suffix=".txt"
-            )
-            temp_file.write("\n".join(lines))
-            temp_file.flush()
-            temp_path = Path(temp_file.name)
+            # Пишем построчно в асинхронный temp-файл, без склейки всего экспорта в одну строку
+            async with aiofiles.tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", delete=False, suffix=".txt"
+            ) as f:
+                temp_path = Path(str(f.name))
+                await f.writelines(export_lines())
 
             # Aiogram ожидает путь (str) или открытый файловый объект; Path не поддерживается
             with temp_path.open("rb") as fh:
@@ -344,9 +403,8 @@ class TelegramBot:
             logger.exception("Failed to send export file to user")
             await msg.answer("⚠️ Не удалось отправить файл с валидными адресами.")
         finally:
-            if temp_file:
-                temp_file.close()
-                Path(temp_file.name).unlink(missing_ok=True)
+            if temp_path:
+                temp_path.unlink(missing_ok=True)
 
     async def run(self):
         logger.info("🤖 Bot started polling...")